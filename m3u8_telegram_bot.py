@@ -2,11 +2,22 @@ import os
 import sys
 import logging
 import asyncio
+import mmap
+import re
+import shutil
+import functools
+import glob
 import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import aiofiles
+from cachetools import TTLCache
 import yt_dlp
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
@@ -14,7 +25,8 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
-from telegram.error import NetworkError, TelegramError
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 
 # Configure logging
@@ -44,19 +56,159 @@ QUALITY_OPTIONS = [
     ('360p', '💻 Low (360p)'),
     ('audio', '🎵 Audio Only')
 ]
+QUALITY_LABELS = dict(QUALITY_OPTIONS)
+
+# yt-dlp format selector for each quality option
+FORMAT_BY_QUALITY = {
+    'auto': 'best',
+    '1080p': 'bestvideo[height<=1080]+bestaudio/best',
+    '720p': 'bestvideo[height<=720]+bestaudio/best',
+    '480p': 'bestvideo[height<=480]+bestaudio/best',
+    '360p': 'bestvideo[height<=360]+bestaudio/best',
+    'audio': 'bestaudio/best',
+}
+
+# First http(s) URL in a message
+URL_RE = re.compile(r'https?://\S+', re.IGNORECASE)
+
+# Static command replies, built once at import
+QUALITIES_LIST = "\n".join(f"• {name}" for _, name in QUALITY_OPTIONS)
+
+START_TEXT = (
+    f"🕒 Bot Time: {CURRENT_TIME}\n"
+    f"👤 Developer: @{CURRENT_USER}\n\n"
+    "📝 *How to use:*\n"
+    "1. Send any M3U8 or stream URL\n"
+    "2. Select quality\n"
+    "3. Wait for download\n\n"
+    "⚡ Features:\n"
+    "• Multiple formats support\n"
+    "• Quality selection\n"
+    "• Progress tracking\n"
+    "• Auto-split large files\n\n"
+    "Type /help for more information"
+)
+
+HELP_TEXT = (
+    "*📖 Help Guide*\n\n"
+    "*🎥 Supported Formats:*\n"
+    "• M3U8 Streams (.m3u8)\n"
+    "• MP4 Videos (.mp4)\n"
+    "• HLS Streams\n"
+    "• DASH Streams\n\n"
+    "*📊 Available Qualities:*\n"
+    f"{QUALITIES_LIST}\n\n"
+    "*💡 Commands:*\n"
+    "/start - Start bot\n"
+    "/help - Show this message\n"
+    "/status - Check bot status\n\n"
+    "*📝 Notes:*\n"
+    "• Large files are split automatically\n"
+    "• One download at a time per user\n"
+    "• You can cancel downloads anytime\n\n"
+    f"🕒 Current Time: {CURRENT_TIME}\n"
+    f"👤 Developer: @{CURRENT_USER}"
+)
+
+# Shown under the status message while a download is running
+CANCEL_KEYBOARD = InlineKeyboardMarkup([[
+    InlineKeyboardButton("❌ Cancel", callback_data="cancel_dl")
+]])
+
+# Quality selection offered for every URL
+QUALITY_KEYBOARD = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton(name, callback_data=f"quality_{quality}")]
+        for quality, name in QUALITY_OPTIONS
+    ]
+    + [[InlineKeyboardButton("❌ Cancel", callback_data="cancel")]]
+)
+
+def _mb(n):
+    """Bytes to mebibytes, for display"""
+    return n / (1 << 20)
 
 class StreamDownloader:
-    def __init__(self, max_size_mb=49):
+    def __init__(self, max_size_mb=49, max_workers=None):
         self.max_bytes = max_size_mb * 1024 * 1024
-        self.temp_dir = "/tmp/downloads"
+        # Point at a tmpfs mount to keep download/split I/O off the disk
+        self.temp_dir = os.getenv("TEMP_DIR", "/tmp/downloads")
+        # Split files up to this size straight from memory instead of disk reads
+        self.tmp_max_memory = int(os.getenv("TMP_MAX_MEMORY", 128 * 1024 * 1024))
+        # HLS/DASH fragments fetched in parallel per download
+        self.fragment_workers = int(os.getenv("HLS_PARALLEL", 16))
+        # Parts of a split file uploaded at the same time
+        self.upload_workers = int(os.getenv("UPLOAD_PARALLEL", 3))
+        self.max_downloads = int(os.getenv("MAX_DOWNLOADS", 100))
         os.makedirs(self.temp_dir, exist_ok=True)
         self.downloads = {}
-
-    async def download(self, url: str, quality: str, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        self._progress = {}
+        self._last_edit = {}
+        if max_workers is None:
+            max_workers = int(os.getenv("WORKERS", os.cpu_count() or 4))
+        # Downloads beyond this many wait their turn instead of all running
+        self._slots = asyncio.Semaphore(max_workers)
+        # yt-dlp is blocking; run it off the event loop with a bounded pool
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        # Idle YoutubeDL instances per quality, reused across downloads;
+        # only the most recently used qualities are kept
+        self._ydl_idle = OrderedDict()
+        self._ydl_max_qualities = 4
+        self._ydl_hooks = {}
+
+    def _ydl_opts(self, quality: str) -> dict:
+        """Build yt-dlp options for a quality"""
+        return {
+            'format': FORMAT_BY_QUALITY[quality],
+            # Relative to the per-download 'paths' set in download()
+            'outtmpl': f"%(title)s_{quality}.%(ext)s",
+            # Merging/fixup already runs ffmpeg with -c copy and
+            # -movflags +faststart, so no extra postprocessor args are needed
+            'merge_output_format': 'mp4',
+            'retries': 10,
+            'fragment_retries': 10,
+            'concurrent_fragment_downloads': self.fragment_workers,
+            'quiet': True,
+            'no_warnings': True,
+            'noplaylist': True,
+        }
+
+    def _acquire_ydl(self, quality: str):
+        """Take an idle YoutubeDL for this quality or create a new one"""
+        idle = self._ydl_idle.get(quality)
+        if idle:
+            ydl = idle.pop()
+            if not idle:
+                # Empty entries would still count against the LRU bound
+                del self._ydl_idle[quality]
+            return ydl
+
+        ydl = yt_dlp.YoutubeDL(self._ydl_opts(quality))
+
+        # The instance outlives a single download, so route its progress
+        # to whichever download currently holds it
+        def dispatch(d):
+            hook = self._ydl_hooks.get(ydl)
+            if hook:
+                hook(d)
+
+        ydl.add_progress_hook(dispatch)
+        return ydl
+
+    def _release_ydl(self, quality: str, ydl):
+        """Return a YoutubeDL to the idle pool"""
+        self._ydl_hooks.pop(ydl, None)
+        self._ydl_idle.setdefault(quality, []).append(ydl)
+        self._ydl_idle.move_to_end(quality)
+        while len(self._ydl_idle) > self._ydl_max_qualities:
+            _, stale = self._ydl_idle.popitem(last=False)
+            for old in stale:
+                old.close()
+
+    async def download(self, url: str, quality: str, update: Update):
         """Download stream and send to Telegram"""
         chat = update.effective_chat
         user_id = update.effective_user.id
-        message = update.callback_query.message if update.callback_query else update.message
 
         if user_id in self.downloads:
             await chat.send_message(
@@ -64,114 +216,57 @@ class StreamDownloader:
             )
             return
 
-        self.downloads[user_id] = True
+        if len(self.downloads) >= self.max_downloads:
+            logger.warning(f"Download limit reached, rejecting user {user_id}")
+            await chat.send_message(
+                "⚠️ The bot is busy right now. Please try again later."
+            )
+            return
 
+        # The job runs in a task of its own so cancel() never touches the
+        # handler task PTB is awaiting. Registered before the first await so
+        # a double tap can't pass the checks above twice
+        task = asyncio.create_task(self._run_download(url, quality, update, user_id))
+        self.downloads[user_id] = task
         try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                # The handler itself was cancelled, take the job down with it
+                task.cancel()
+                raise
+
+    async def _run_download(self, url: str, quality: str, update: Update, user_id: int):
+        """Body of a registered download, from queueing to cleanup"""
+        task = asyncio.current_task()
+        chat = update.effective_chat
+        message = update.callback_query.message if update.callback_query else update.message
+        # Private directory per download, so equal titles never collide
+        job_dir = os.path.join(self.temp_dir, uuid.uuid4().hex)
+        status_msg = message
+
+        try:
+            await asyncio.to_thread(os.makedirs, job_dir)
             # Initial status message
-            status_msg = message
             if not update.callback_query:
                 status_msg = await chat.send_message(
                     f"📥 Starting download...\n"
-                    f"📊 Quality: {dict(QUALITY_OPTIONS)[quality]}\n"
+                    f"📊 Quality: {QUALITY_LABELS[quality]}\n"
                     f"🕒 Time: {CURRENT_TIME}\n"
                     f"👤 User: @{CURRENT_USER}"
                 )
 
-            # Configure download options
-            ydl_opts = {
-                'format': (
-                    'bestvideo[height<=?]+bestaudio/best'
-                    if quality != 'auto' else 'best'
-                ).replace('?', quality[:-1]) if quality != 'audio' else 'bestaudio/best',
-                'outtmpl': f"{self.temp_dir}/%(title)s_{quality}.%(ext)s",
-                'merge_output_format': 'mp4',
-                'retries': 10,
-                'fragment_retries': 10,
-                'http_chunk_size': 10485760,
-                'quiet': True,
-                'no_warnings': True,
-            }
-
-            def progress_hook(d):
-                if d['status'] == 'downloading':
-                    try:
-                        if 'total_bytes' in d:
-                            percent = (d['downloaded_bytes'] / d['total_bytes']) * 100
-                            speed = d.get('speed', 0)
-                            speed_str = f"{speed/1024/1024:.1f} MB/s" if speed else "N/A"
-                            eta = d.get('eta', 'N/A')
-                            
-                            progress_text = (
-                                f"⏳ Downloading: {percent:.1f}%\n"
-                                f"⚡ Speed: {speed_str}\n"
-                                f"⏱ ETA: {eta} seconds\n"
-                                f"📊 Quality: {dict(QUALITY_OPTIONS)[quality]}\n"
-                                f"🕒 Time: {CURRENT_TIME}\n"
-                                f"👤 User: @{CURRENT_USER}"
-                            )
-                        else:
-                            mb = d['downloaded_bytes'] / 1024 / 1024
-                            progress_text = (
-                                f"⏳ Downloaded: {mb:.1f}MB\n"
-                                f"📊 Quality: {dict(QUALITY_OPTIONS)[quality]}\n"
-                                f"🕒 Time: {CURRENT_TIME}"
-                            )
-                        
-                        context.job_queue.run_once(
-                            lambda _: self.update_status(status_msg, progress_text),
-                            0
-                        )
-                    except Exception as e:
-                        logger.error(f"Progress hook error: {e}")
-
-            ydl_opts['progress_hooks'] = [progress_hook]
-
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                await self.update_status(status_msg, "🔍 Analyzing stream...")
-                info = ydl.extract_info(url, download=False)
-                file_path = ydl.prepare_filename(info)
-                
-                await self.update_status(status_msg, 
-                    f"📥 Downloading...\n"
-                    f"🎥 Format: {info.get('format', 'Unknown')}\n"
-                    f"📊 Quality: {dict(QUALITY_OPTIONS)[quality]}"
+            # Bound concurrent jobs; waiters are served in arrival order
+            if self._slots.locked():
+                await self.update_status(
+                    status_msg,
+                    "⏳ Queued, waiting for a free download slot...",
+                    reply_markup=CANCEL_KEYBOARD
+                )
+            async with self._slots:
+                await self._download_job(
+                    url, quality, chat, status_msg, user_id, task, job_dir
                 )
-                
-                ydl.download([url])
-
-                if not os.path.exists(file_path):
-                    raise Exception("Download failed - file not found")
-
-                size = os.path.getsize(file_path)
-                if size == 0:
-                    raise Exception("Downloaded file is empty")
-
-                if size > self.max_bytes:
-                    await self.update_status(
-                        status_msg,
-                        f"⚠️ File is large ({size/1024/1024:.1f}MB). Splitting..."
-                    )
-                    await self.split_and_send(file_path, chat, status_msg)
-                else:
-                    await self.update_status(status_msg, "📤 Uploading to Telegram...")
-                    caption = (
-                        f"🎥 Download Complete\n\n"
-                        f"📊 Quality: {dict(QUALITY_OPTIONS)[quality]}\n"
-                        f"💾 Size: {size/1024/1024:.1f}MB\n"
-                        f"🕒 Time: {CURRENT_TIME}\n"
-                        f"👤 User: @{CURRENT_USER}"
-                    )
-                    
-                    with open(file_path, 'rb') as f:
-                        await chat.send_document(
-                            document=f,
-                            filename=os.path.basename(file_path),
-                            caption=caption
-                        )
-
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                await self.update_status(status_msg, "✅ Download completed!")
 
         except Exception as e:
             error_msg = f"❌ Error: {str(e)}"
@@ -183,115 +278,406 @@ class StreamDownloader:
                 f"👤 User: @{CURRENT_USER}"
             )
         finally:
-            if user_id in self.downloads:
+            await asyncio.to_thread(shutil.rmtree, job_dir, ignore_errors=True)
+            self._last_edit.pop((status_msg.chat_id, status_msg.message_id), None)
+            if self.downloads.get(user_id) is task:
                 del self.downloads[user_id]
 
-    async def split_and_send(self, file_path: str, chat, status_msg):
+    async def _download_job(self, url, quality, chat, status_msg, user_id, task, job_dir):
+        """Fetch the stream into job_dir and upload it"""
+        def progress_hook(d):
+            # Runs in the yt-dlp thread; raising here aborts the download
+            if self.downloads.get(user_id) is not task:
+                raise yt_dlp.utils.DownloadCancelled()
+            if d['status'] == 'downloading':
+                # Keep only the latest snapshot; formatting it is left to
+                # _progress_pump, which runs once per interval on the loop.
+                # A plain dict store is safe from this thread.
+                self._progress[user_id] = d
+
+        loop = asyncio.get_running_loop()
+        ydl = self._acquire_ydl(quality)
+        try:
+            self._ydl_hooks[ydl] = progress_hook
+            ydl.params['paths'] = {'home': job_dir}
+            await self.update_status(
+                status_msg, "🔍 Analyzing stream...", reply_markup=CANCEL_KEYBOARD
+            )
+            pump = asyncio.create_task(self._progress_pump(status_msg, user_id, quality))
+            future = loop.run_in_executor(
+                self._pool, functools.partial(ydl.extract_info, url, download=True)
+            )
+            try:
+                info = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Stop status edits first: yt-dlp runs no hooks while merging,
+                # so the wait below can outlast the cancel reply
+                pump.cancel()
+                self._progress.pop(user_id, None)
+                # Let yt-dlp hit the cancel check before the instance is reused
+                await asyncio.wait([future])
+                future.exception()  # Expected DownloadCancelled, mark it seen
+                raise
+            finally:
+                pump.cancel()
+                self._progress.pop(user_id, None)
+            file_path = (
+                info.get('requested_downloads', [{}])[0].get('filepath')
+                or ydl.prepare_filename(info)
+            )
+        finally:
+            self._release_ydl(quality, ydl)
+
+        try:
+            size = await asyncio.to_thread(os.path.getsize, file_path)
+        except OSError:
+            raise Exception("Download failed - file not found")
+        if size == 0:
+            raise Exception("Downloaded file is empty")
+
+        if size > self.max_bytes:
+            await self.update_status(
+                status_msg,
+                f"⚠️ File is large ({_mb(size):.1f}MB). Splitting...",
+                reply_markup=CANCEL_KEYBOARD
+            )
+            await self.split_and_send(
+                file_path, chat, status_msg, duration=info.get('duration')
+            )
+        else:
+            await self.update_status(
+                status_msg, "📤 Uploading to Telegram...", reply_markup=CANCEL_KEYBOARD
+            )
+            caption = (
+                f"🎥 Download Complete\n\n"
+                f"📊 Quality: {QUALITY_LABELS[quality]}\n"
+                f"💾 Size: {_mb(size):.1f}MB\n"
+                f"🕒 Time: {CURRENT_TIME}\n"
+                f"👤 User: @{CURRENT_USER}"
+            )
+            
+            # PTB loads the whole document into memory before upload,
+            # so read it off the event loop and hand over the bytes
+            async with aiofiles.open(file_path, 'rb') as f:
+                content = await f.read()
+            await chat.send_document(
+                document=content,
+                filename=os.path.basename(file_path),
+                caption=caption
+            )
+
+        await self.update_status(status_msg, "✅ Download completed!")
+
+    def cancel(self, user_id: int) -> bool:
+        """Stop a user's active download, returns False if there is none"""
+        task = self.downloads.pop(user_id, None)
+        if task is None:
+            return False
+        task.cancel()
+        return True
+
+    async def split_and_send(self, file_path: str, chat, status_msg, duration=None):
         """Split large files and send in parts"""
         try:
-            file_size = os.path.getsize(file_path)
+            file_size = await asyncio.to_thread(os.path.getsize, file_path)
             base_name = os.path.basename(file_path)
             name, ext = os.path.splitext(base_name)
             
-            total_parts = -(-file_size // self.max_bytes)
-            
-            with open(file_path, 'rb') as f:
+            segments = await self._ffmpeg_segments(file_path, file_size, duration)
+            if segments:
+                total_parts = len(segments)
+            else:
+                total_parts = -(-file_size // self.max_bytes)
+            if segments:
+                parts = self._segment_parts(segments)
+            elif file_size <= self.tmp_max_memory:
+                parts = self._mapped_parts(file_path)
+            else:
+                parts = self._file_parts(file_path, total_parts)
+            # Parts in flight; a slot is taken before a part is read, so this
+            # also bounds how many parts are held in memory
+            slots = asyncio.Semaphore(self.upload_workers)
+            sends = []
+
+            def failed():
+                # Stop reading once a part has failed; gather() re-raises it
+                return any(t.done() and t.exception() for t in sends)
+
+            try:
                 for part in range(total_parts):
-                    content = f.read(self.max_bytes)
-                    if not content:
+                    await slots.acquire()
+                    if failed():
                         break
-                        
-                    part_name = f"{name}_part{part+1}of{total_parts}{ext}"
-                    part_path = os.path.join(self.temp_dir, part_name)
-                    
-                    with open(part_path, 'wb') as part_file:
-                        part_file.write(content)
-                    
-                    await self.update_status(
-                        status_msg,
-                        f"📤 Sending part {part+1}/{total_parts}\n"
-                        f"🕒 Time: {CURRENT_TIME}"
-                    )
-                    
-                    with open(part_path, 'rb') as part_file:
-                        await chat.send_document(
-                            document=part_file,
-                            filename=part_name,
-                            caption=(
-                                f"📦 Part {part+1}/{total_parts}\n"
-                                f"🕒 Time: {CURRENT_TIME}\n"
-                                f"👤 User: @{CURRENT_USER}"
-                            )
-                        )
-                    
-                    os.remove(part_path)
-                    await asyncio.sleep(1)
+                    try:
+                        content = await parts.__anext__()
+                    except StopAsyncIteration:
+                        slots.release()
+                        break
+                    sends.append(asyncio.create_task(self._send_part(
+                        slots, chat, status_msg, content, part, total_parts, name, ext
+                    )))
+                    # Only the send task should keep this part alive
+                    del content
+
+                await asyncio.gather(*sends)
+            except BaseException:
+                for t in sends:
+                    t.cancel()
+                raise
+            finally:
+                await parts.aclose()
 
         except Exception as e:
             logger.error(f"Split and send error: {e}")
             raise
 
+    async def _segment_parts(self, segments):
+        """Read each ffmpeg segment as one part"""
+        for segment in segments:
+            async with aiofiles.open(segment, 'rb') as f:
+                yield await f.read()
+
+    async def _mapped_parts(self, file_path: str):
+        """Copy max_bytes parts out of a memory mapping of the file"""
+        # The file was just written, so its pages are still cached;
+        # slice the mapping instead of reading it back through a file
+        with open(file_path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                memoryview(mm) as mv:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+
+            def take(start):
+                # Slicing the view is free; bytes() is the one copy
+                # Telegram's upload needs
+                content = bytes(mv[start:start + self.max_bytes])
+                if hasattr(mmap, 'MADV_DONTNEED'):
+                    # The copy is what gets sent, so drop the window
+                    # from our resident set right away
+                    mm.madvise(mmap.MADV_DONTNEED, start, len(content))
+                return content
+
+            loop = asyncio.get_running_loop()
+
+            async def copy(start):
+                # The copy may fault pages in from disk, so it runs
+                # in a thread; the mapping must outlive it
+                future = loop.run_in_executor(None, take, start)
+                try:
+                    return await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    await asyncio.wait([future])
+                    raise
+
+            for start in range(0, len(mm), self.max_bytes):
+                yield await copy(start)
+
+    async def _file_parts(self, file_path: str, total_parts: int):
+        """Read the file in max_bytes parts"""
+        async with aiofiles.open(file_path, 'rb') as f:
+            for _ in range(total_parts):
+                yield await f.read(self.max_bytes)
+
+    async def _ffmpeg_segments(self, file_path: str, file_size: int, duration=None):
+        """Cut into playable parts under max_bytes, or None to split by bytes"""
+        if not duration:
+            duration = await self._probe_duration(file_path)
+            if not duration:
+                return None
+
+        # Fixed names in the job's private directory: titles may contain '%',
+        # which the segment muxer would read as part of the pattern
+        out_dir = os.path.dirname(file_path)
+        ext = os.path.splitext(file_path)[1]
+        pattern = os.path.join(out_dir, f"seg%03d{ext.replace('%', '%%')}")
+        # Cuts land on keyframes and bitrate varies, so aim below the limit
+        segment_time = duration * self.max_bytes / file_size * 0.9
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                'ffmpeg', '-hide_banner', '-loglevel', 'error',
+                '-i', file_path,
+                '-map', '0', '-c', 'copy',
+                '-f', 'segment',
+                '-segment_time', f"{segment_time:.3f}",
+                '-reset_timestamps', '1',
+                pattern,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except FileNotFoundError:
+            logger.warning("ffmpeg not found, splitting by bytes")
+            return None
+
+        try:
+            _, stderr = await proc.communicate()
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+
+        def list_segments():
+            segments = sorted(glob.glob(os.path.join(
+                glob.escape(out_dir), f"seg[0-9][0-9][0-9]{glob.escape(ext)}"
+            )))
+            return segments, [os.path.getsize(p) for p in segments]
+
+        def remove(paths):
+            for p in paths:
+                os.remove(p)
+
+        segments, sizes = await asyncio.to_thread(list_segments)
+        if proc.returncode != 0 or not segments:
+            logger.warning(
+                f"ffmpeg segmenting failed: "
+                f"{stderr.decode(errors='replace').strip()}, splitting by bytes"
+            )
+        elif max(sizes) > self.max_bytes:
+            logger.warning("ffmpeg produced an oversized part, splitting by bytes")
+        else:
+            return segments
+
+        await asyncio.to_thread(remove, segments)
+        return None
+
     @staticmethod
-    async def update_status(message, text: str):
+    async def _probe_duration(file_path: str):
+        """Media duration in seconds from ffprobe, or None"""
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                'ffprobe', '-v', 'error',
+                '-show_entries', 'format=duration',
+                '-of', 'default=noprint_wrappers=1:nokey=1',
+                file_path,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+        except FileNotFoundError:
+            return None
+        try:
+            out, _ = await proc.communicate()
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+        try:
+            return float(out)
+        except ValueError:
+            return None
+
+    async def _send_part(self, slots, chat, status_msg, content, part, total_parts, name, ext):
+        """Send one part of a split file, then free its upload slot"""
+        part_name = f"{name}_part{part+1}of{total_parts}{ext}"
+        
+        try:
+            await self.update_status(
+                status_msg,
+                f"📤 Sending part {part+1}/{total_parts}\n"
+                f"🕒 Time: {CURRENT_TIME}",
+                reply_markup=CANCEL_KEYBOARD
+            )
+            
+            # No fixed pause between parts: the application's AIORateLimiter
+            # backs off only when Telegram actually asks it to
+            await chat.send_document(
+                document=content,
+                filename=part_name,
+                caption=(
+                    f"📦 Part {part+1}/{total_parts}\n"
+                    f"🕒 Time: {CURRENT_TIME}\n"
+                    f"👤 User: @{CURRENT_USER}"
+                )
+            )
+        finally:
+            slots.release()
+
+    async def _progress_pump(self, status_msg, user_id, quality, interval=2):
+        """Send the latest progress at most once per interval"""
+        while True:
+            await asyncio.sleep(interval)
+            d = self._progress.get(user_id)
+            if not d:
+                continue
+            try:
+                text = self._progress_text(d, quality)
+            except Exception as e:
+                logger.error(f"Progress format error: {e}")
+                continue
+            await self.update_status(status_msg, text, reply_markup=CANCEL_KEYBOARD)
+
+    @staticmethod
+    def _progress_text(d, quality: str) -> str:
+        """Format a yt-dlp progress snapshot for the status message"""
+        if 'total_bytes' in d:
+            percent = (d['downloaded_bytes'] / d['total_bytes']) * 100
+            speed = d.get('speed', 0)
+            speed_str = f"{_mb(speed):.1f} MB/s" if speed else "N/A"
+            eta = d.get('eta', 'N/A')
+            
+            return (
+                f"⏳ Downloading: {percent:.1f}%\n"
+                f"⚡ Speed: {speed_str}\n"
+                f"⏱ ETA: {eta} seconds\n"
+                f"📊 Quality: {QUALITY_LABELS[quality]}\n"
+                f"🕒 Time: {CURRENT_TIME}\n"
+                f"👤 User: @{CURRENT_USER}"
+            )
+        mb = _mb(d['downloaded_bytes'])
+        return (
+            f"⏳ Downloaded: {mb:.1f}MB\n"
+            f"📊 Quality: {QUALITY_LABELS[quality]}\n"
+            f"🕒 Time: {CURRENT_TIME}"
+        )
+
+    async def update_status(self, message, text: str, reply_markup=None):
         """Update status message with retry logic"""
-        for _ in range(3):
+        # Telegram rejects edits that change nothing, so skip the round trip
+        key = (message.chat_id, message.message_id)
+        if self._last_edit.get(key) == text:
+            return
+        attempts = 3
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
             try:
-                await message.edit_text(text)
-                break
+                await message.edit_text(text, reply_markup=reply_markup)
+                self._last_edit[key] = text
+                return
+            except RetryAfter as e:
+                # No point waiting out the flood limit if we won't retry
+                if not last:
+                    await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                if 'not modified' in str(e).lower():
+                    self._last_edit[key] = text
+                else:
+                    # Permanent (e.g. message deleted), retrying can't help
+                    logger.error(f"Status update error: {e}")
+                return
+            except NetworkError as e:
+                # Includes TimedOut; transient, so back off and retry
+                logger.warning(f"Status update error: {e}")
+                if not last:
+                    await asyncio.sleep(2 ** attempt)
             except Exception as e:
                 logger.error(f"Status update error: {e}")
-                await asyncio.sleep(1)
+                return
 
 class TelegramBot:
     def __init__(self):
         self.downloader = StreamDownloader()
-        self.pending_downloads = {}
+        # Unanswered quality prompts expire instead of piling up
+        self.pending_downloads = TTLCache(maxsize=10_000, ttl=600)
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
         user = update.effective_user
         await update.effective_chat.send_message(
-            f"👋 Welcome {user.mention_html()}!\n\n"
-            f"🕒 Bot Time: {CURRENT_TIME}\n"
-            f"👤 Developer: @{CURRENT_USER}\n\n"
-            "📝 *How to use:*\n"
-            "1. Send any M3U8 or stream URL\n"
-            "2. Select quality\n"
-            "3. Wait for download\n\n"
-            "⚡ Features:\n"
-            "• Multiple formats support\n"
-            "• Quality selection\n"
-            "• Progress tracking\n"
-            "• Auto-split large files\n\n"
-            "Type /help for more information",
+            f"👋 Welcome {user.mention_html()}!\n\n" + START_TEXT,
             parse_mode="HTML"
         )
 
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /help command"""
-        qualities_list = "\n".join([f"• {name}" for _, name in QUALITY_OPTIONS])
-        
-        await update.effective_chat.send_message(
-            "*📖 Help Guide*\n\n"
-            "*🎥 Supported Formats:*\n"
-            "• M3U8 Streams (.m3u8)\n"
-            "• MP4 Videos (.mp4)\n"
-            "• HLS Streams\n"
-            "• DASH Streams\n\n"
-            "*📊 Available Qualities:*\n"
-            f"{qualities_list}\n\n"
-            "*💡 Commands:*\n"
-            "/start - Start bot\n"
-            "/help - Show this message\n"
-            "/status - Check bot status\n\n"
-            "*📝 Notes:*\n"
-            "• Large files are split automatically\n"
-            "• One download at a time per user\n"
-            "• You can cancel downloads anytime\n\n"
-            f"🕒 Current Time: {CURRENT_TIME}\n"
-            f"👤 Developer: @{CURRENT_USER}",
-            parse_mode="Markdown"
-        )
+        await update.effective_chat.send_message(HELP_TEXT, parse_mode="Markdown")
 
     async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /status command"""
@@ -310,30 +696,23 @@ class TelegramBot:
 
     async def handle_url(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle URLs"""
-        url = update.message.text
-        if not url:
+        text = update.message.text
+        match = URL_RE.search(text) if text else None
+        if not match:
+            await update.effective_chat.send_message(
+                "❌ Please send a valid stream URL (http/https)"
+            )
             return
+        url = match.group(0)
 
         # Store the URL for later use
         self.pending_downloads[update.effective_user.id] = url
 
-        # Show quality selection keyboard
-        keyboard = []
-        for quality, name in QUALITY_OPTIONS:
-            keyboard.append([InlineKeyboardButton(
-                name, 
-                callback_data=f"quality_{quality}"
-            )])
-        keyboard.append([InlineKeyboardButton(
-            "❌ Cancel", 
-            callback_data="cancel"
-        )])
-
         await update.effective_chat.send_message(
             f"📊 Select Quality:\n"
             f"🕒 Time: {CURRENT_TIME}\n"
             f"👤 User: @{CURRENT_USER}",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=QUALITY_KEYBOARD
         )
 
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -343,10 +722,16 @@ class TelegramBot:
         
         try:
             await query.answer()
+            # "cancel" (quality menu), "cancel_dl" (running download)
+            # or "quality_<quality>"
+            tag, _, quality = query.data.partition("_")
 
-            if query.data == "cancel":
-                if user_id in self.pending_downloads:
-                    del self.pending_downloads[user_id]
+            if tag == "cancel":
+                if quality == "dl":
+                    self.downloader.cancel(user_id)
+                else:
+                    # Only drop the URL; an earlier download keeps running
+                    self.pending_downloads.pop(user_id, None)
                 await query.edit_message_text(
                     f"❌ Download cancelled\n"
                     f"🕒 Time: {CURRENT_TIME}\n"
@@ -354,9 +739,7 @@ class TelegramBot:
                 )
                 return
 
-            if query.data.startswith("quality_"):
-                quality = query.data.split("_")[1]
-                
+            if tag == "quality":
                 url = self.pending_downloads.get(user_id)
                 if not url:
                     await query.edit_message_text(
@@ -367,15 +750,14 @@ class TelegramBot:
 
                 await query.edit_message_text(
                     f"🚀 Starting download...\n"
-                    f"📊 Quality: {dict(QUALITY_OPTIONS)[quality]}\n"
+                    f"📊 Quality: {QUALITY_LABELS[quality]}\n"
                     f"🕒 Time: {CURRENT_TIME}\n"
                     f"👤 User: @{CURRENT_USER}"
                 )
 
-                await self.downloader.download(url, quality, update, context)
+                await self.downloader.download(url, quality, update)
                 
-                if user_id in self.pending_downloads:
-                    del self.pending_downloads[user_id]
+                self.pending_downloads.pop(user_id, None)
 
         except Exception as e:
             logger.error(f"Callback error: {e}")
@@ -407,10 +789,24 @@ def main():
         application = (
             Application.builder()
             .token(BOT_TOKEN)
-            .read_timeout(30)
-            .write_timeout(30)
-            .connect_timeout(30)
-            .pool_timeout(30)
+            # One pooled HTTP/2 connection carries all uploads, so split
+            # parts don't each pay for a new TLS handshake
+            .request(HTTPXRequest(
+                connection_pool_size=32,
+                http_version="2",
+                read_timeout=60,
+                write_timeout=600,
+                connect_timeout=30,
+                pool_timeout=30,
+            ))
+            .get_updates_request(HTTPXRequest(
+                read_timeout=30,
+                write_timeout=30,
+                connect_timeout=30,
+                pool_timeout=30,
+            ))
+            .concurrent_updates(True)
+            .rate_limiter(AIORateLimiter(max_retries=3))
             .build()
         )
         